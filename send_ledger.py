@@ -0,0 +1,247 @@
+"""Send ledger: records every outgoing message so Streamlit reruns and retries
+after timeouts never send the same message twice."""
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+import base64
+import hashlib
+import os
+import sqlite3
+import threading
+import uuid
+
+SEND_PENDING = 'pending'
+SEND_SENT = 'sent'
+
+# Outcomes of send_once
+SENT = 'sent'
+ALREADY_SENT = 'already_sent'
+IN_FLIGHT = 'in_flight'
+
+# Outcomes of SendLedger.claim
+CLAIMED = 'claimed'
+STALE = 'stale'
+
+# A pending send younger than this may still be running in another session.
+PENDING_GRACE = timedelta(minutes=2)
+# Identical messages are only suppressed within this window, so a deliberate
+# resend later on still goes out.
+SENT_WINDOW = timedelta(hours=1)
+
+
+def _timestamp(moment):
+    # Fixed-width so timestamps compare correctly as strings in SQLite
+    return moment.isoformat(timespec='microseconds')
+
+
+def new_message_id(key):
+    """Build a fresh Message-ID for one send attempt of a key.
+
+    Kept short enough that the header is never folded.
+    """
+    return f"{key[:16]}.{uuid.uuid4().hex[:16]}@gmail-ai-assistant"
+
+
+class SendLedger:
+    """SQLite-backed ledger of in-flight and completed sends.
+
+    SQLite is the source of truth for claims, so several sessions, processes
+    or ledger instances on the same file never claim the same key twice.
+    Recently sent keys are mirrored in an in-memory dict so the common
+    duplicate check needs no query.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sent_messages (
+                idempotency_key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                message_id TEXT,
+                gmail_id TEXT,
+                updated_at TEXT NOT NULL
+            )
+        """)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(sent_messages)")]
+        if 'message_id' not in columns:
+            self._conn.execute("ALTER TABLE sent_messages ADD COLUMN message_id TEXT")
+        self._conn.execute(
+            "DELETE FROM sent_messages WHERE status = ? AND updated_at <= ?",
+            (SEND_SENT, _timestamp(datetime.now() - SENT_WINDOW))
+        )
+        self._conn.commit()
+        self._sent = {
+            key: datetime.fromisoformat(updated_at)
+            for key, updated_at in self._conn.execute(
+                "SELECT idempotency_key, updated_at FROM sent_messages WHERE status = ?",
+                (SEND_SENT,)
+            )
+        }
+
+    def entry(self, key):
+        """Return (status, updated_at, message_id) for a key, or None."""
+        row = self._conn.execute(
+            "SELECT status, updated_at, message_id FROM sent_messages WHERE idempotency_key = ?",
+            (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        status, updated_at, message_id = row
+        return status, datetime.fromisoformat(updated_at), message_id
+
+    def claim(self, key, now=None):
+        """Try to claim a key for sending.
+
+        Returns (outcome, updated_at, message_id) where outcome is CLAIMED,
+        ALREADY_SENT, IN_FLIGHT or STALE. A CLAIMED send must use the returned
+        Message-ID; a STALE pending claim must be reconciled against its
+        Message-ID and then taken over with reclaim().
+        """
+        now = now or datetime.now()
+        with self._lock:
+            sent_at = self._sent.get(key)
+            if sent_at is not None and now - sent_at < SENT_WINDOW:
+                return ALREADY_SENT, sent_at, None
+            self._sent.pop(key, None)
+
+            while True:
+                message_id = new_message_id(key)
+                cursor = self._conn.execute(
+                    "INSERT INTO sent_messages (idempotency_key, status, message_id, gmail_id, updated_at) "
+                    "VALUES (?, ?, ?, NULL, ?) "
+                    "ON CONFLICT(idempotency_key) DO UPDATE SET "
+                    "status = excluded.status, message_id = excluded.message_id, "
+                    "gmail_id = NULL, updated_at = excluded.updated_at "
+                    "WHERE status = ? AND updated_at <= ?",
+                    (key, SEND_PENDING, message_id, _timestamp(now),
+                     SEND_SENT, _timestamp(now - SENT_WINDOW))
+                )
+                self._conn.commit()
+                if cursor.rowcount:
+                    return CLAIMED, now, message_id
+
+                entry = self.entry(key)
+                if entry is None:
+                    # Released by someone else in between; try again
+                    continue
+                status, updated_at, message_id = entry
+                if status == SEND_SENT:
+                    self._sent[key] = updated_at
+                    return ALREADY_SENT, updated_at, message_id
+                if now - updated_at < PENDING_GRACE:
+                    return IN_FLIGHT, updated_at, message_id
+                return STALE, updated_at, message_id
+
+    def reclaim(self, key, expected_updated_at, now=None):
+        """Take over a stale pending claim, unless someone else already has.
+
+        Returns the Message-ID for the new attempt, or None.
+        """
+        now = now or datetime.now()
+        message_id = new_message_id(key)
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE sent_messages SET message_id = ?, updated_at = ? "
+                "WHERE idempotency_key = ? AND status = ? AND updated_at = ?",
+                (message_id, _timestamp(now), key, SEND_PENDING, _timestamp(expected_updated_at))
+            )
+            self._conn.commit()
+            return message_id if cursor.rowcount else None
+
+    def complete(self, key, message_id, gmail_id, now=None):
+        """Mark the send attempt carrying message_id as sent."""
+        now = now or datetime.now()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE sent_messages SET status = ?, gmail_id = ?, updated_at = ? "
+                "WHERE idempotency_key = ? AND message_id = ?",
+                (SEND_SENT, gmail_id, _timestamp(now), key, message_id)
+            )
+            self._conn.commit()
+            if cursor.rowcount:
+                self._sent[key] = now
+
+    def release(self, key, message_id):
+        """Forget a pending send attempt that definitely did not go out."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM sent_messages WHERE idempotency_key = ? AND status = ? AND message_id = ?",
+                (key, SEND_PENDING, message_id)
+            )
+            self._conn.commit()
+
+
+def make_idempotency_key(sender, to_email, subject, body, source_message_id=None):
+    """Build a deterministic key for a message from its sender, recipient, subject, body and source message."""
+    body_hash = hashlib.sha256(body.encode('utf-8')).hexdigest()
+    parts = [
+        sender.strip().lower(),
+        to_email.strip().lower(),
+        subject.strip(),
+        body_hash,
+        source_message_id or ''
+    ]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def find_sent_message(service, message_id):
+    """Look in the Sent folder for the message with this Message-ID.
+
+    Returns the Gmail message id, or None if the message was never sent.
+    """
+    result = service.users().messages().list(
+        userId='me',
+        q=f"in:sent rfc822msgid:{message_id}",
+        maxResults=1
+    ).execute()
+    messages = result.get('messages', [])
+    return messages[0]['id'] if messages else None
+
+
+def _is_rejection(error):
+    # googleapiclient's HttpError carries the HTTP response on .resp
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return status is not None and int(status) < 500
+
+
+def send_once(service, ledger, sender, to_email, subject, body, source_message_id=None):
+    """Send a message through the Gmail API at most once per idempotency key.
+
+    Returns SENT, ALREADY_SENT or IN_FLIGHT. Errors from the API are re-raised;
+    a rejected message (4xx) is released so it can be retried, anything else
+    is left pending and reconciled against the Sent folder on a later attempt.
+    """
+    key = make_idempotency_key(sender, to_email, subject, body, source_message_id)
+    outcome, updated_at, message_id = ledger.claim(key)
+    if outcome == STALE:
+        gmail_id = find_sent_message(service, message_id)
+        if gmail_id:
+            ledger.complete(key, message_id, gmail_id)
+            return ALREADY_SENT
+        message_id = ledger.reclaim(key, updated_at)
+        if not message_id:
+            return IN_FLIGHT
+    elif outcome != CLAIMED:
+        return outcome
+
+    message = MIMEText(body)
+    message['to'] = to_email
+    message['subject'] = subject
+    message['Message-ID'] = f"<{message_id}>"
+    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+    try:
+        sent = service.users().messages().send(
+            userId='me',
+            body={'raw': raw}
+        ).execute()
+    except Exception as e:
+        if _is_rejection(e):
+            ledger.release(key, message_id)
+        raise
+
+    ledger.complete(key, message_id, sent.get('id'))
+    return SENT
@@ -4,10 +4,9 @@ import random
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
-from email.mime.text import MIMEText
-import base64
 import os
 import json
+from send_ledger import SendLedger, send_once, SENT, ALREADY_SENT, IN_FLIGHT
 
 # Page config
 st.set_page_config(
@@ -111,6 +110,7 @@ def get_gmail_service():
                     if flow:
                         flow.fetch_token(code=st.query_params['code'])
                         st.session_state.credentials = flow.credentials
+                        st.session_state.pop('sender_email', None)
                         st.success("Successfully authenticated!")
                         st.rerun()
                 except Exception as e:
@@ -131,31 +131,51 @@ def get_gmail_service():
 
     return None
 
-def send_email(to_email, subject, body):
-    """Send email using Gmail API."""
+SEND_LEDGER_PATH = os.path.join('instance', 'send_ledger.db')
+
+
+@st.cache_resource
+def get_send_ledger():
+    """Get the process-wide send ledger (shared across reruns and sessions)."""
+    return SendLedger(SEND_LEDGER_PATH)
+
+
+def get_sender_email(service):
+    """Get the address of the signed-in Gmail account."""
+    if not st.session_state.get('sender_email'):
+        profile = service.users().getProfile(userId='me').execute()
+        st.session_state.sender_email = profile['emailAddress']
+    return st.session_state.sender_email
+
+
+def send_email(to_email, subject, body, source_message_id=None):
+    """Send email using Gmail API, at most once per idempotency key.
+
+    Returns SENT, ALREADY_SENT or IN_FLIGHT, or None if the send failed.
+    """
     service = get_gmail_service()
     if not service:
-        return False
+        return None
 
     try:
-        message = MIMEText(body)
-        message['to'] = to_email
-        message['subject'] = subject
-        
-        # Encode the message
-        raw = base64.urlsafe_b64encode(message.as_bytes())
-        raw = raw.decode()
-        
-        # Send the message
-        service.users().messages().send(
-            userId='me',
-            body={'raw': raw}
-        ).execute()
-        
-        return True
+        result = send_once(
+            service,
+            get_send_ledger(),
+            get_sender_email(service),
+            to_email,
+            subject,
+            body,
+            source_message_id
+        )
     except Exception as e:
         st.error(f"Error sending email: {str(e)}")
-        return False
+        return None
+
+    if result == ALREADY_SENT:
+        st.info("This message has already been sent.")
+    elif result == IN_FLIGHT:
+        st.info("This message is already being sent.")
+    return result
 
 # Sample data with more realistic content
 SAMPLE_EMAILS = [
@@ -426,13 +446,15 @@ if st.session_state.page == 'inbox':
                 st.markdown("### Generated Response")
                 response = st.text_area("Edit Response:", st.session_state.responses[email['id']], height=300)
                 if st.button("Send Response"):
-                    if send_email(
+                    result = send_email(
                         email['from'],
                         f"Re: {email['subject']}",
-                        response + "\n\n" + st.session_state.user_profile['signature']
-                    ):
+                        response + "\n\n" + st.session_state.user_profile['signature'],
+                        source_message_id=email['id']
+                    )
+                    if result == SENT:
                         st.success("Response sent successfully.")
-                    else:
+                    elif result is None:
                         st.error("Failed to send email. Please check your email settings.")
         else:
             st.info("Select an email from the inbox to view details")
@@ -453,13 +475,14 @@ elif st.session_state.page == 'composer':
                 st.success("Email saved as draft.")
         with col2:
             if st.form_submit_button("Send"):
-                if send_email(
+                result = send_email(
                     to_email,
                     subject,
                     full_message
-                ):
+                )
+                if result == SENT:
                     st.success("Email sent successfully.")
-                else:
+                elif result is None:
                     st.error("Failed to send email. Please check your email settings.")
 
 elif st.session_state.page == 'settings':
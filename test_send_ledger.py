@@ -0,0 +1,206 @@
+from datetime import datetime
+from email import message_from_bytes
+import base64
+
+import pytest
+
+from send_ledger import (
+    SendLedger, send_once, make_idempotency_key,
+    SEND_PENDING, SEND_SENT, PENDING_GRACE, SENT_WINDOW,
+    SENT, ALREADY_SENT, IN_FLIGHT, CLAIMED, STALE
+)
+
+
+class FakeRequest:
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+
+    def execute(self):
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class FakeService:
+    """Stands in for the Gmail API client: service.users().messages().send/list."""
+
+    def __init__(self, send_error=None, sent_folder=None):
+        self.send_error = send_error
+        # Message-ID -> Gmail id of messages already in the Sent folder
+        self.sent_folder = sent_folder or {}
+        self.sent = []
+        self.queries = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body):
+        if self.send_error:
+            return FakeRequest(error=self.send_error)
+        self.sent.append(body)
+        return FakeRequest({'id': f"gmail-{len(self.sent)}"})
+
+    def list(self, userId, q, maxResults):
+        self.queries.append(q)
+        message_id = q.split('rfc822msgid:')[1]
+        found = self.sent_folder.get(message_id)
+        return FakeRequest({'messages': [{'id': found}]} if found else {})
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeHttpError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.resp = FakeResponse(status)
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return SendLedger(str(tmp_path / 'ledger.db'))
+
+
+def send(service, ledger, sender='me@x.com', source_message_id=None):
+    return send_once(service, ledger, sender, 'bob@x.com', 'Thanks', 'Hello', source_message_id)
+
+
+def key(sender='me@x.com', source_message_id=None):
+    return make_idempotency_key(sender, 'bob@x.com', 'Thanks', 'Hello', source_message_id)
+
+
+def test_key_is_deterministic_and_normalised():
+    assert make_idempotency_key('Me@x.com', ' Bob@x.com ', 'Hi', 'b', '1') == \
+        make_idempotency_key('me@x.com', 'bob@x.com', 'Hi', 'b', '1')
+    assert key('a@x.com') != key('b@x.com')
+    assert key(source_message_id='1') != key(source_message_id='2')
+
+
+def test_duplicate_is_short_circuited(ledger):
+    service = FakeService()
+    assert send(service, ledger) == SENT
+    assert send(service, ledger) == ALREADY_SENT
+    assert len(service.sent) == 1
+
+
+def test_different_senders_are_not_deduplicated(ledger):
+    service = FakeService()
+    assert send(service, ledger, sender='a@x.com') == SENT
+    assert send(service, ledger, sender='b@x.com') == SENT
+    assert len(service.sent) == 2
+
+
+def test_sent_entries_expire_after_window(ledger):
+    k = key()
+    now = datetime.now()
+    _, _, message_id = ledger.claim(k, now=now - SENT_WINDOW)
+    ledger.complete(k, message_id, 'gmail-1', now=now - SENT_WINDOW)
+    outcome, updated_at, new_message_id = ledger.claim(k, now=now)
+    assert (outcome, updated_at) == (CLAIMED, now)
+    assert new_message_id != message_id
+
+
+def test_each_send_gets_a_fresh_message_id(ledger):
+    service = FakeService()
+    send(service, ledger, sender='a@x.com')
+    send(service, ledger, sender='b@x.com')
+    assert ledger.entry(key('a@x.com'))[2] != ledger.entry(key('b@x.com'))[2]
+    sent = message_from_bytes(base64.urlsafe_b64decode(service.sent[0]['raw']))
+    assert sent['Message-ID'] == f"<{ledger.entry(key('a@x.com'))[2]}>"
+
+
+def test_ledger_survives_reopen(tmp_path):
+    path = str(tmp_path / 'ledger.db')
+    ledger = SendLedger(path)
+    _, _, message_id = ledger.claim('k')
+    ledger.complete('k', message_id, 'gmail-1')
+    assert SendLedger(path).entry('k')[0] == SEND_SENT
+
+
+def test_expired_sent_rows_are_pruned_on_open(tmp_path):
+    path = str(tmp_path / 'ledger.db')
+    ledger = SendLedger(path)
+    then = datetime.now() - SENT_WINDOW
+    _, _, message_id = ledger.claim('old', now=then)
+    ledger.complete('old', message_id, 'gmail-1', now=then)
+    ledger.claim('pending', now=then)
+    reopened = SendLedger(path)
+    assert reopened.entry('old') is None
+    assert reopened.entry('pending')[0] == SEND_PENDING
+
+
+def test_claims_are_shared_between_ledgers_on_one_file(tmp_path):
+    path = str(tmp_path / 'ledger.db')
+    first, second = SendLedger(path), SendLedger(path)
+    assert first.claim('k')[0] == CLAIMED
+    assert second.claim('k')[0] == IN_FLIGHT
+
+
+def test_rejected_send_is_released(ledger):
+    with pytest.raises(FakeHttpError):
+        send(FakeService(send_error=FakeHttpError(400)), ledger)
+    assert ledger.entry(key()) is None
+    assert send(FakeService(), ledger) == SENT
+
+
+@pytest.mark.parametrize('error', [FakeHttpError(503), TimeoutError('timed out')])
+def test_uncertain_send_is_left_pending(ledger, error):
+    with pytest.raises(type(error)):
+        send(FakeService(send_error=error), ledger)
+    assert ledger.entry(key())[0] == SEND_PENDING
+
+
+def test_recent_pending_is_in_flight(ledger):
+    ledger.claim(key())
+    service = FakeService()
+    assert send(service, ledger) == IN_FLIGHT
+    assert service.sent == [] and service.queries == []
+
+
+def test_stale_pending_found_in_sent_folder(ledger):
+    k = key()
+    _, _, message_id = ledger.claim(k, now=datetime.now() - PENDING_GRACE)
+    service = FakeService(sent_folder={message_id: 'gmail-7'})
+    assert send(service, ledger) == ALREADY_SENT
+    assert service.sent == []
+    assert service.queries == [f"in:sent rfc822msgid:{message_id}"]
+    assert ledger.entry(k)[0] == SEND_SENT
+
+
+def test_stale_pending_not_found_is_resent(ledger):
+    ledger.claim(key(), now=datetime.now() - PENDING_GRACE)
+    service = FakeService()
+    assert send(service, ledger) == SENT
+    assert len(service.sent) == 1
+    assert ledger.entry(key())[0] == SEND_SENT
+
+
+def test_timed_out_resend_does_not_match_earlier_send(ledger):
+    k = key()
+    now = datetime.now()
+    first_sent_at = now - PENDING_GRACE - SENT_WINDOW
+    _, _, old_message_id = ledger.claim(k, now=first_sent_at)
+    ledger.complete(k, old_message_id, 'gmail-1', now=first_sent_at)
+    # The window expires, the resend is claimed and then times out
+    outcome, _, resend_message_id = ledger.claim(k, now=now - PENDING_GRACE)
+    assert outcome == CLAIMED
+
+    service = FakeService(sent_folder={old_message_id: 'gmail-1'})
+    assert send(service, ledger) == SENT
+    assert service.queries == [f"in:sent rfc822msgid:{resend_message_id}"]
+    assert len(service.sent) == 1
+
+
+def test_reclaim_fails_if_claim_changed(ledger):
+    k = key()
+    then = datetime.now() - PENDING_GRACE
+    ledger.claim(k, now=then)
+    assert ledger.claim(k)[:2] == (STALE, then)
+    assert ledger.reclaim(k, then)
+    assert ledger.reclaim(k, then) is None